@@ -1,18 +1,24 @@
+import asyncio
+import random
 import sys
-import time
 from dotenv import load_dotenv
 import os
-from orb import Orb
+from orb import AsyncOrb
 import orb
 import csv
 import logging
-import datetime
-import uuid
+import time
+from datetime import datetime as _dt, UTC as _UTC
+import hashlib
+import httpx
+import mmap
+import orjson
+from collections.abc import Iterator
+from typing import Any
 
 # Set up logging
 # Keep it simple
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
 ch = logging.StreamHandler()
 ch.setLevel(logging.DEBUG)
 formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
@@ -26,176 +32,419 @@ load_dotenv()
 # Access environment variables
 ORB_API_KEY = os.getenv("ORB_API_KEY")
 
+# Default to INFO so per-row debug logging costs nothing; set LOG_LEVEL=DEBUG to see it
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+# CSV file of transactions to be ingested as events
+CSV_PATH = "data/Orb Technical Support Engineer (TSE) - Technical Exercise - sample_data - sample_data.csv"
+
+# Maximum number of rows being worked on against the Orb API at once
+MAX_CONCURRENCY = 8
+
+# Number of events sent per ingest request (Orb accepts up to 500)
+BATCH_SIZE = 500
+
+# Number of workers ingesting events, and how many rows may wait in the queue for them
+N_WORKERS = 4
+QUEUE_SIZE = 1000
+
+# Size of the HTTP connection pool shared by all in-flight requests
+MAX_CONNECTIONS = 50
+
+# Exponential backoff settings used when the API returns a 408/429/5xx or can't be reached
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 32.0
+BACKOFF_MAX_ATTEMPTS = 6
+
+
+# Translation table that deletes thousands separators, built once at import
+_COMMA_TBL = str.maketrans("", "", ",")
+
 
 def parse_int(value: str) -> int:
     """Convert a string to an integer, removing commas and returning 0 if the value is empty"""
-    if value == "":
+    if not value:
         return 0
-    return int(value.replace(",", ""))
-
-
-def main() -> None:
-    # Create Orb client
-    client = Orb(api_key=ORB_API_KEY)
-
-    with open(
-        "data/Orb Technical Support Engineer (TSE) - Technical Exercise - sample_data - sample_data.csv",
-        "r",
-    ) as file:
-        # Read the CSV file of transactions to be ingested as events
-        csv_reader = csv.DictReader(file)
-        for row in csv_reader:
-            logger.debug("Processing row: %s", row)
-            # Create null customer placeholder
-            customer = None
-            logger.debug("Checking for customer with account_id: %s", row["account_id"])
-
-            # Try to find customer by external_customer_id
+    return int(value.translate(_COMMA_TBL))
+
+
+class OrjsonAsyncClient(httpx.AsyncClient):
+    """httpx client that serializes JSON request bodies with orjson instead of the stdlib json module"""
+
+    def build_request(self, *args, json: Any = None, **kwargs) -> httpx.Request:
+        if json is not None:
+            # orjson produces bytes directly, so hand them over as the raw body
+            kwargs["content"] = orjson.dumps(json)
+            headers = httpx.Headers(kwargs.get("headers"))
+            headers.setdefault("Content-Type", "application/json")
+            kwargs["headers"] = headers
+        return super().build_request(*args, **kwargs)
+
+
+def read_csv(path: str) -> Iterator[list[str]]:
+    """Stream rows, header included, from a CSV file through a read-only memory map"""
+    with open(path, "rb") as file:
+        # An empty file can't be memory mapped and has no rows anyway
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # Lines are read straight out of the page cache and decoded one at a time
+            for row in csv.reader(
+                line.decode("utf-8") for line in iter(mm.readline, b"")
+            ):
+                # Skip blank lines, the same as DictReader did
+                if row:
+                    yield row
+
+
+async def call_with_backoff(fn, *args, **kwargs):
+    """Await an API call, backing off and retrying on 408/429/5xx or when the server can't be reached"""
+    for attempt in range(BACKOFF_MAX_ATTEMPTS):
+        try:
+            return await fn(*args, **kwargs)
+        except (orb.APIStatusError, orb.APIConnectionError) as e:
+            # Only transient errors are retried, anything else goes straight to the caller
+            if isinstance(e, orb.APIStatusError) and not (
+                isinstance(e, (orb.RateLimitError, orb.InternalServerError))
+                or e.status_code == 408
+            ):
+                raise
+            # Give up and let the caller handle the error on the last attempt
+            if attempt == BACKOFF_MAX_ATTEMPTS - 1:
+                raise
+            # Use exponential backoff with jitter
+            delay = min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt)
+            delay *= random.uniform(0.5, 1.0)
+            if isinstance(e, orb.RateLimitError):
+                # Honor the server's Retry-After header if it sent one
+                try:
+                    delay = float(e.response.headers.get("Retry-After"))
+                except (TypeError, ValueError):
+                    pass
+                logger.warning(
+                    "A 429 status code was received; backing off for %.2f seconds",
+                    delay,
+                )
+            elif isinstance(e, orb.APIStatusError):
+                logger.warning(
+                    "A %s status code was received; retrying in %.2f seconds",
+                    e.status_code,
+                    delay,
+                )
+            else:
+                logger.warning(
+                    "The server could not be reached; retrying in %.2f seconds", delay
+                )
+            await asyncio.sleep(delay)
+
+
+async def resolve_customer_id(
+    client: AsyncOrb, semaphore: asyncio.Semaphore, account_id: str
+) -> str | None:
+    """Find the Orb customer for an account_id, creating it if it doesn't exist, or None on failure"""
+    # Derive the display fields once, up front
+    # Prettyfy name for display in the Orb UI
+    pretty = account_id.replace("_", " ").title()
+    email_host = account_id.replace("_", "-")
+
+    async with semaphore:
+        # Create null customer placeholder
+        customer = None
+        logger.debug("Creating customer for account_id: %s", account_id)
+
+        # Try to create the customer straight away rather than checking for it first,
+        # the deterministic idempotency key makes a replayed create return the same customer
+        try:
+            customer = await call_with_backoff(
+                client.customers.create,
+                external_customer_id=account_id,
+                name=pretty,
+                email=f"admin@{email_host}.com",  # Create a dummy email for the customer
+                idempotency_key=f"cust-{account_id}",  # Deterministic so a retried create can't duplicate the customer
+            )
+        except orb.APIConnectionError as e:
+            # If the server still could not be reached after retrying, exit
+            logger.error("The server could not be reached")
+            logger.error("Underlying exception: %s", e.__cause__)
+            logger.error("Exiting")
+            sys.exit(1)
+        except orb.RateLimitError as e:
+            # If we are still rate limited after backing off, exit and rerun the script later
+            logger.error("Still rate limited after backing off... %s", e)
+            logger.error("Exiting")
+            sys.exit(1)
+        except (orb.DuplicateResourceCreation, orb.ConflictError):
+            # The customer already exists, proceed to fetch it
+            # At this point customer is None
+            logger.debug("Customer already exists for account_id: %s", account_id)
+        except orb.APIStatusError as e:
+            # If another non-200-range status code was received, skip this account
+            logger.error("Another non-200-range status code was received")
+            logger.error("Status code: %s", e.status_code)
+            logger.error("Response: %s", e.response.text)
+            logger.error("Skipping account_id: %s", account_id)
+            return None
+        except Exception as e:
+            # If any other error occurs, exit
+            logger.error("Error creating customer: %s", e)
+            logger.error("Exiting")
+            sys.exit(1)
+
+        # Fetch the customer by external_customer_id if it already existed
+        if customer is None:
             try:
-                customer = client.customers.fetch_by_external_id(
-                    external_customer_id=row["account_id"]
+                customer = await call_with_backoff(
+                    client.customers.fetch_by_external_id,
+                    external_customer_id=account_id,
                 )
             except orb.APIConnectionError as e:
-                # If the server could not be reached, exit
+                # If the server still could not be reached after retrying, exit
                 logger.error("The server could not be reached")
                 logger.error("Underlying exception: %s", e.__cause__)
                 logger.error("Exiting")
                 sys.exit(1)
             except orb.RateLimitError as e:
-                # If a 429 status code was received, exit and rerun the script later
-                logger.error(
-                    "A 429 status code was received; we should back off a bit... %s", e
-                )
+                # If we are still rate limited after backing off, exit and rerun the script later
+                logger.error("Still rate limited after backing off... %s", e)
                 logger.error("Exiting")
                 sys.exit(1)
             except orb.APIStatusError as e:
-                # A 404 status code indicates that the customer does not exist, proceed to create
+                # Any other status won't go away on retry, skip this account and carry on
                 logger.error("Another non-200-range status code was received")
-                if e.status_code == 404:
-                    # At this point customer is None
-                    logger.error(
-                        "Status was 404, customer not found, creating new customer"
-                    )
-                else:
-                    logger.error("Status code: %s", e.status_code)
-                    logger.error("Response: %s", e.response.json())
-                    logger.error("Exiting")
-                    sys.exit(1)
+                logger.error("Status code: %s", e.status_code)
+                logger.error("Response: %s", e.response.text)
+                logger.error("Skipping account_id: %s", account_id)
+                return None
             except Exception as e:
                 # If any other error occurs, exit
                 logger.error("Error fetching customer: %s", e)
                 logger.error("Exiting")
                 sys.exit(1)
 
-            # Create customer if they don't exist
-            if customer is None:
-                logger.debug("Creating customer for account_id: %s", row["account_id"])
-                try:
-                    # Attempt to create the customer
-                    customer = client.customers.create(
-                        external_customer_id=row["account_id"],
-                        name=row["account_id"].replace("_", " ").title(),  # Prettyfy name for display in the Orb UI
-                        email=f"admin@{row['account_id'].replace('_', '-')}.com",  # Create a dummy email for the customer
-                        idempotency_key=str(uuid.uuid4()),  # Generate a unique idempotency key for the customer
-                    )
-                except orb.APIConnectionError as e:
-                    # If the server could not be reached, exit
-                    logger.error("The server could not be reached")
-                    logger.error("Underlying exception: %s", e.__cause__)
-                    logger.error("Exiting")
-                    sys.exit(1)
-                except orb.RateLimitError as e:
-                    # If a 429 status code was received, exit and rerun the script later
-                    logger.error(
-                        "A 429 status code was received; we should back off a bit... %s",
-                        e,
-                    )
-                    logger.error("Exiting")
-                    sys.exit(1)
-                except orb.APIStatusError as e:
-                    # If another non-200-range status code was received, exit
-                    logger.error("Another non-200-range status code was received")
-                    logger.error("Status code: %s", e.status_code)
-                    logger.error("Response: %s", e.response.json())
-                    logger.error("Exiting")
-                    sys.exit(1)
-                except Exception as e:
-                    # If any other error occurs, exit
-                    logger.error("Error creating customer: %s", e)
-                    logger.error("Exiting")
-                    sys.exit(1)
+            # If the customer was found, log it
+            logger.debug("Customer found: %s (ID: %s)", account_id, customer.id)
 
-            else:
-                # If the customer was found, log it
-                logger.debug(
-                    "Customer found: %s (ID: %s)", row["account_id"], customer.id
+        return customer.id
+
+
+async def ingest_events(client: AsyncOrb, events: list[dict]) -> None:
+    """Ingest a batch of events in a single request, logging rather than exiting on failure"""
+    logger.debug("Attempting to ingest %s events", len(events))
+
+    # Create null response placeholder
+    response = None
+
+    # Dont exit on any errors, just log them and move on
+    try:
+        # Attempt to ingest the whole batch
+        response = await call_with_backoff(client.events.ingest, events=events)
+
+    except orb.APIConnectionError as e:
+        logger.error("The server could not be reached")
+        logger.error("Underlying exception: %s", e.__cause__)
+    except orb.RateLimitError as e:
+        logger.error("Still rate limited after backing off... %s", e)
+    except orb.APIStatusError as e:
+        logger.error("Another non-200-range status code was received")
+        logger.error("Status code: %s", e.status_code)
+        logger.error("Response: %s", e.response.text)
+
+    except Exception as e:
+        logger.error("Error ingesting events: %s", e)
+
+    if response is not None:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Successfully ingested batch of %s events", len(events))
+            logger.debug("Response: %s", response)
+        # Individual events can still be rejected even when the request succeeds
+        for failure in response.validation_failed:
+            logger.error(
+                "Event %s failed validation: %s",
+                failure.idempotency_key,
+                failure.validation_errors,
+            )
+    else:
+        logger.error(
+            "Failed to ingest batch of %s events: %s",
+            len(events),
+            [event["properties"]["transaction_id"] for event in events],
+        )
+
+
+async def csv_producer(
+    queue: asyncio.Queue[list[str] | None], rows: Iterator[list[str]]
+) -> None:
+    """Feed CSV rows into the queue, followed by one stop sentinel per worker"""
+    for row in rows:
+        # Blocks while the queue is full so memory stays bounded by QUEUE_SIZE
+        await queue.put(row)
+    for _ in range(N_WORKERS):
+        await queue.put(None)
+
+
+async def ingest_worker(
+    client: AsyncOrb,
+    queue: asyncio.Queue[list[str] | None],
+    customer_ids: dict[str, str | None],
+    idx: dict[str, int],
+) -> None:
+    """Turn queued CSV rows into events and ingest them in batches"""
+    acct_i = idx["account_id"]
+    month_i = idx["month"]
+    txn_i = idx["transaction_id"]
+    type_i = idx["account_type"]
+    bank_i = idx["bank_id"]
+    standard_i = idx["standard"]
+    sameday_i = idx["sameday"]
+
+    # Buffer events and flush them in batches rather than one request per row
+    events_buffer: list[dict] = []
+    # Events are stamped with ingestion time rather than the row's month, Orb
+    # rejects events that fall outside its ingestion grace period
+    # The ISO string is only rebuilt once a second, rows in between reuse it
+    _now = _dt.now
+    _monotonic = time.monotonic
+    last_t = float("-inf")
+    ts = ""
+    # Checked once up front rather than paying for a debug call on every row
+    debug_enabled = logger.isEnabledFor(logging.DEBUG)
+    while True:
+        row = await queue.get()
+        if row is None:
+            # The producer is done, flush whatever is left over and stop
+            try:
+                if events_buffer:
+                    await ingest_events(client, events_buffer)
+            finally:
+                queue.task_done()
+            return
+
+        # A bad row is failed on its own, it mustn't take the worker down with it
+        try:
+            if debug_enabled:
+                logger.debug("Processing row: %s", row)
+
+            acct = row[acct_i]
+            txn = row[txn_i]
+
+            # Rows for accounts whose customer couldn't be resolved are failed individually
+            customer_id = customer_ids[acct]
+            if customer_id is None:
+                logger.error(
+                    "No customer for account_id %s, skipping transaction %s", acct, txn
                 )
+                continue
+
+            t = _monotonic()
+            if t - last_t > 1.0:
+                ts = _now(_UTC).isoformat()
+                last_t = t
 
             # Create event payload
             # Date must be in ISO format
-            # Idempotency should be a UUID v4
+            # Idempotency key is derived from the transaction so retries are deduplicated
             event = {
-                "customer_id": customer.id,
+                "customer_id": customer_id,
                 # You can only use customer_id or external_customer_id, not both
-                # "external_customer_id": row["account_id"],
-                "timestamp": datetime.datetime.now(datetime.UTC).isoformat(),
-                "idempotency_key": str(uuid.uuid4()),
+                # "external_customer_id": acct,
+                "timestamp": ts,
+                "idempotency_key": hashlib.sha256(f"{txn}|{acct}".encode()).hexdigest(),
                 "event_name": "payment_transaction",
                 "properties": {
-                    "transaction_id": row["transaction_id"],
-                    "account_type": row["account_type"],
-                    "bank_id": row["bank_id"],
-                    "standard": parse_int(row["standard"]),
-                    "sameday": parse_int(row["sameday"]),
-                    "month": row["month"],
+                    "transaction_id": txn,
+                    "account_type": row[type_i],
+                    "bank_id": row[bank_i],
+                    "standard": parse_int(row[standard_i]),
+                    "sameday": parse_int(row[sameday_i]),
+                    "month": row[month_i],
                 },
             }
+            events_buffer.append(event)
+            if len(events_buffer) >= BATCH_SIZE:
+                # Swap the buffer out first so a failed flush can't resend these events
+                batch, events_buffer = events_buffer, []
+                await ingest_events(client, batch)
+        except Exception as e:
+            logger.error("Error processing row %s, skipping it: %s", row, e)
+        finally:
+            queue.task_done()
 
-            logger.debug("Attempting to ingest event: %s", event)
 
-            # Create null response placeholder
-            response = None
+async def main() -> None:
+    # Create async Orb client
+    # Retries are handled by call_with_backoff so the SDK's own retries are disabled
+    # One HTTP/2 connection pool is reused for every request so we only pay for TLS once
+    client = AsyncOrb(
+        api_key=ORB_API_KEY,
+        max_retries=0,
+        # Event batches are serialized with orjson, which is much faster than json
+        http_client=OrjsonAsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_CONNECTIONS,
+            ),
+        ),
+    )
 
-            # Dont exit on any errors, just log them and move on
-            try:
-                # Attempt to ingest the event
-                response = client.events.ingest(events=[event])
-
-            except orb.APIConnectionError as e:
-                logger.error("The server could not be reached")
-                logger.error("Underlying exception: %s", e.__cause__)
-            except orb.RateLimitError as e:
-                logger.error(
-                    "A 429 status code was received; we should back off a bit... %s", e
-                )
-            except orb.APIStatusError as e:
-                logger.error("Another non-200-range status code was received")
-                logger.error("Status code: %s", e.status_code)
-                logger.error("Response: %s", e.response.json())
+    # Read the CSV file of transactions to be ingested as events
+    # Plain rows are cheaper than DictReader, columns are looked up by index
+    rows = read_csv(CSV_PATH)
+    header = next(rows, None)
+    if header is None:
+        logger.info("CSV file is empty, nothing to ingest")
+        await client.close()
+        return
+    idx = {name: i for i, name in enumerate(header)}
+    acct_i = idx["account_id"]
 
-            except Exception as e:
-                logger.error("Error ingesting event: %s", e)
+    # First pass: collect the distinct accounts referenced by the transactions
+    # Rows are streamed rather than held in memory, so the file is read again below
+    accounts: set[str] = {row[acct_i] for row in rows}
 
-            # Sleep for 1.5 seconds to avoid rate limiting
-            if response is not None:
-                logger.debug(
-                    "Successfully ingested event for transaction %s",
-                    row["transaction_id"],
-                )
-                logger.debug("Response: %s", response)
-            else:
-                logger.error(
-                    "Failed to ingest event for transaction %s", row["transaction_id"]
-                )
+    # Second pass: resolve or create every customer up front, concurrently
+    # Bound the number of requests in flight so we don't flood the API
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    customer_ids: dict[str, str | None] = dict(
+        zip(
+            accounts,
+            await asyncio.gather(
+                *(resolve_customer_id(client, semaphore, a) for a in accounts)
+            ),
+        )
+    )
 
-            # Sleep for 1.5 seconds to avoid rate limiting
-            time.sleep(1.5)
+    # Third pass: stream rows through a bounded queue to workers that build and ingest events
+    # using only dict lookups, no customer API calls
+    rows = read_csv(CSV_PATH)
+    # Skip the header
+    if next(rows, None) is None:
+        logger.info("CSV file is empty, nothing to ingest")
+        await client.close()
+        return
+    queue: asyncio.Queue[list[str] | None] = asyncio.Queue(maxsize=QUEUE_SIZE)
+    workers = [
+        asyncio.create_task(ingest_worker(client, queue, customer_ids, idx))
+        for _ in range(N_WORKERS)
+    ]
+    producer = asyncio.create_task(csv_producer(queue, rows))
+    # Workers only return once they've seen their sentinel, after every row has been
+    # handled. Stop waiting as soon as any task fails rather than hanging on the queue
+    done, pending = await asyncio.wait(
+        {producer, *workers}, return_when=asyncio.FIRST_EXCEPTION
+    )
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    for task in done:
+        # Re-raises the exception of a failed producer or worker
+        task.result()
 
     logger.debug("Closing Orb client")
     # Not sure if this is necessary but it seems like a graceful exit
-    client.close()
+    await client.close()
     logger.debug("Finished ingesting events")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())